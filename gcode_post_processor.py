@@ -2,7 +2,8 @@ import re
 import os
 import math
 import numpy as np
-from shapely.geometry import Point, Polygon, MultiPoint, LineString
+import shapely
+from shapely.geometry import Polygon, MultiPoint
 from shapely.ops import unary_union
 from shapely.affinity import translate
 import matplotlib.pyplot as plt
@@ -10,6 +11,12 @@ from mpl_toolkits.mplot3d import Axes3D  # For 3D plotting
 from matplotlib.widgets import Slider
 import trimesh
 
+try:
+    from numba import njit, prange
+    NUMBA_AVAILABLE = True
+except ImportError:  # Fall back to the NumPy/Shapely implementation.
+    NUMBA_AVAILABLE = False
+
 # --- FUNCTIONS TO LOAD MODIFIER GEOMETRY ---
 
 def load_modifier_polygon_from_stl_2d(stl_filename):
@@ -52,15 +59,38 @@ def load_modifier_mesh_3d(stl_filename):
     r_max = float(np.max(distances))
     return {"mesh": mesh, "vertices": vertices, "faces": faces, "centroid": centroid, "r_max": r_max}
 
+def make_gradient_function(exponent):
+    """
+    Return a function computing normalized ** exponent, specialized for
+    the common exponents 1 and 2 so they avoid the generic pow.
+    """
+    if exponent == 1:
+        return lambda n: n
+    if exponent == 2:
+        return lambda n: n * n
+    return lambda n: n ** exponent
+
 # --- CONFIGURATION ---
-pattern_x = re.compile(r'X([-+]?[0-9]*\.?[0-9]+)')
-pattern_y = re.compile(r'Y([-+]?[0-9]*\.?[0-9]+)')
-pattern_z = re.compile(r'Z([-+]?[0-9]*\.?[0-9]+)')
-pattern_e = re.compile(r'E([-+]?[0-9]*\.?[0-9]+)')
+# The G-code is processed as raw bytes, so the patterns are bytes patterns.
+# One pass over a G1 line yields every axis word; the first occurrence of each letter wins.
+pattern_token = re.compile(rb'([XYZE])([-+]?[0-9]*\.?[0-9]+)')
+pattern_z = re.compile(rb'Z([-+]?[0-9]*\.?[0-9]+)')
+pattern_e = re.compile(rb'E([-+]?[0-9]*\.?[0-9]+)')
 
 input_file = "input.gcode"       # G-code generated by PrusaSlicer.
 output_file = "output.gcode"     # Modified output G-code.
 
+# Positions and multipliers are processed in single precision: G-code positions
+# carry at most three decimals, so float32 halves memory traffic without visible
+# error. Extrusion amounts and the running E total stay in double precision.
+COORD_DTYPE = np.float32
+
+# Set to True to compute the multipliers with the compiled Numba kernels when
+# numba is installed. The NumPy/Shapely path is the default: on the sample
+# configurations it was as fast or faster, and the kernels' first run adds
+# their compilation (about 3 s).
+USE_NUMBA = False
+
 # --- MODIFIER DEFINITIONS ---
 # In each modifier definition you can specify:
 #   - "modifier_type": "2D" or "3D"
@@ -84,13 +114,19 @@ for mod_def in modifier_defs:
             if "offset" in mod_def:
                 dx, dy = mod_def["offset"]
                 polygon = translate(polygon, xoff=dx, yoff=dy)
+            # Prepare once so every contains test reuses the polygon's spatial index.
+            shapely.prepare(polygon)
             centroid = polygon.centroid  # 2D centroid (Point)
-            r_max = max(centroid.distance(Point(v)) for v in polygon.exterior.coords)
+            coords = np.asarray(polygon.exterior.coords)   # float64, like the Shapely polygon
+            r_max = float(np.max(np.hypot(coords[:, 0] - centroid.x, coords[:, 1] - centroid.y)))
             mod_params = {
                 "modifier_type": "2D",
                 "polygon": polygon,
-                "centroid_2d": centroid,
+                "poly_xy": coords,
+                "cx": centroid.x,   # 2D centroid, cached as plain floats
+                "cy": centroid.y,
                 "r_max": r_max,
+                "inv_r_max": 1.0 / r_max,
                 "center_multiplier": mod_def["center_multiplier"],
                 "edge_multiplier": mod_def["edge_multiplier"],
                 "gradient_exponent": mod_def.get("gradient_exponent", 1.0),
@@ -114,6 +150,7 @@ for mod_def in modifier_defs:
                 "faces": mesh_info["faces"],
                 "centroid_3d": mesh_info["centroid"],
                 "r_max": mesh_info["r_max"],
+                "r_max_sq": mesh_info["r_max"]**2,
                 "center_multiplier": mod_def["center_multiplier"],
                 "edge_multiplier": mod_def["edge_multiplier"],
                 "gradient_exponent": mod_def.get("gradient_exponent", 1.0),
@@ -123,11 +160,12 @@ for mod_def in modifier_defs:
         else:
             print(f"Unknown modifier type for file {mfile}; skipping.")
             continue
+        mod_params["gradient_fn"] = make_gradient_function(mod_params["gradient_exponent"])
         modifiers.append(mod_params)
         print(f"Loaded modifier from '{mfile}' as type {mod_type}:")
         if mod_type == "2D":
             print(mod_params["polygon"])
-            print(f"Centroid (2D): ({mod_params['centroid_2d'].x:.2f}, {mod_params['centroid_2d'].y:.2f}), r_max: {mod_params['r_max']:.2f}")
+            print(f"Centroid (2D): ({mod_params['cx']:.2f}, {mod_params['cy']:.2f}), r_max: {mod_params['r_max']:.2f}")
         elif mod_type == "3D":
             cx, cy, cz = mod_params["centroid_3d"]
             print(f"Centroid (3D): ({cx:.2f}, {cy:.2f}, {cz:.2f}), r_max: {mod_params['r_max']:.2f}")
@@ -135,150 +173,433 @@ for mod_def in modifier_defs:
     else:
         print(f"Modifier STL file '{mfile}' not found. Skipping.")
 
-# --- FUNCTION TO COMPUTE MULTIPLIER FOR A SINGLE MODIFIER ---
-def compute_multiplier_for_modifier(x, y, z, mod):
-    if z < mod["min_layer"]:
-        return 1.0
-    if mod["modifier_type"] == "2D":
-        pt2d = Point(x, y)
-        if not mod["polygon"].contains(pt2d):
+# --- NUMBA KERNELS ---
+# Compiled counterpart of compute_effective_multiplier and the functions it
+# uses; with USE_NUMBA set and numba installed it handles all moves in one
+# call. Modifiers are passed as one array per parameter, and the polygon rings
+# as one flat vertex array plus offsets (see build_modifier_arrays), so a
+# single compiled function handles every modifier. The kernels are compiled
+# without fastmath so every sample rounds the same way as in the NumPy path.
+MODIFIER_2D = 0
+MODIFIER_3D = 1
+
+if NUMBA_AVAILABLE:
+    @njit(cache=True)
+    def ring_crossings(x, y, ring_xy):
+        # Crossing-number test against a closed ring of vertices: 1 if the
+        # ray from (x, y) crosses the ring an odd number of times, 0 if even,
+        # -1 if the point lies on an edge.
+        inside = 0
+        j = ring_xy.shape[0] - 1
+        for i in range(ring_xy.shape[0]):
+            xi, yi = ring_xy[i, 0], ring_xy[i, 1]
+            xj, yj = ring_xy[j, 0], ring_xy[j, 1]
+            # Positive when (x, y) lies left of the edge j -> i, zero when collinear.
+            cross = (xi - xj) * (y - yj) - (x - xj) * (yi - yj)
+            if cross == 0.0 and min(xi, xj) <= x <= max(xi, xj) and min(yi, yj) <= y <= max(yi, yj):
+                return -1
+            if (yi > y) != (yj > y) and (cross > 0.0) == (yi > yj):
+                inside = 1 - inside
+            j = i
+        return inside
+
+    @njit(cache=True)
+    def point_in_rings(x, y, first_ring, last_ring, ring_offsets, ring_xy):
+        # Even-odd rule over rings first_ring..last_ring - 1 (exteriors and holes of
+        # disjoint polygons). Points on any edge are outside, as with shapely.contains_xy.
+        inside = 0
+        for r in range(first_ring, last_ring):
+            crossings = ring_crossings(x, y, ring_xy[ring_offsets[r]:ring_offsets[r + 1]])
+            if crossings < 0:
+                return False
+            inside ^= crossings
+        return inside == 1
+
+    @njit(cache=True)
+    def apply_gradient(normalized, exponent):
+        # Same specialization as make_gradient_function, resolved per call in compiled code.
+        if exponent == 1.0:
+            return normalized
+        if exponent == 2.0:
+            return normalized * normalized
+        return normalized ** exponent
+
+    @njit(cache=True)
+    def modifier_kernel(x, y, z, kind, hull_ring, ring_offsets, ring_xy, cx, cy, cz, r_max, r_eff_scale,
+                        center, edge, exponent, min_layer):
+        if z < min_layer:
             return 1.0
-        r = pt2d.distance(mod["centroid_2d"])
-        norm_base = mod["r_max"]
+        if kind == MODIFIER_2D:
+            if not point_in_rings(x, y, hull_ring, hull_ring + 1, ring_offsets, ring_xy):
+                return 1.0
+            normalized = min(math.hypot(x - cx, y - cy) * (1.0 / r_max), 1.0)
+        else:
+            # Squared distances reject points outside the sphere slice without a sqrt.
+            dz = z - cz
+            r_max_sq = r_max * r_max
+            if dz * dz > r_max_sq:
+                return 1.0
+            r_eff_sq = r_eff_scale * r_eff_scale * (r_max_sq - dz * dz)
+            dx = x - cx
+            dy = y - cy
+            d_sq = dx * dx + dy * dy
+            if d_sq > r_eff_sq:
+                return 1.0
+            if r_eff_sq <= 0.0:
+                normalized = 1.0
+            elif exponent == 2.0:
+                return center - (center - edge) * min(d_sq / r_eff_sq, 1.0)
+            else:
+                normalized = min(math.sqrt(d_sq / r_eff_sq), 1.0)
+        return center - (center - edge) * apply_gradient(normalized, exponent)
+
+    @njit(cache=True)
+    def multiplier_multiple_kernel(x, y, z, kinds, hull_rings, ring_offsets, ring_xy, cxs, cys, czs, r_maxes,
+                                   r_eff_scales, centers, edges, exponents, min_layers):
+        overall = 1.0
+        for m in range(kinds.shape[0]):
+            overall *= modifier_kernel(x, y, z, kinds[m], hull_rings[m], ring_offsets, ring_xy, cxs[m], cys[m],
+                                       czs[m], r_maxes[m], r_eff_scales[m], centers[m], edges[m], exponents[m],
+                                       min_layers[m])
+        return overall
+
+    @njit(cache=True)
+    def same_side_kernel(sx, sy, ex, ey, z, union_thresholds, union_rings, ring_offsets, ring_xy):
+        # True unless the move crosses the boundary of the union of the 2D modifiers
+        # applicable at z, chosen like the searchsorted lookup of the NumPy path.
+        u = -1
+        while u + 1 < union_thresholds.shape[0] and union_thresholds[u + 1] <= z:
+            u += 1
+        if u < 0:
+            return True
+        start_inside = point_in_rings(sx, sy, union_rings[u], union_rings[u + 1], ring_offsets, ring_xy)
+        end_inside = point_in_rings(ex, ey, union_rings[u], union_rings[u + 1], ring_offsets, ring_xy)
+        return start_inside == end_inside
+
+    @njit(parallel=True, cache=True)
+    def process_moves(sx, sy, ex, ey, zs, num_samples, kinds, hull_rings, cxs, cys, czs, r_maxes, r_eff_scales,
+                      centers, edges, exponents, min_layers, union_thresholds, union_rings, ring_offsets, ring_xy):
+        # Effective multiplier of every move; moves are independent, so they run in parallel.
+        out = np.empty(sx.shape[0])   # float64, like the fallback's multipliers
+        for k in prange(sx.shape[0]):
+            dx = ex[k] - sx[k]
+            dy = ey[k] - sy[k]
+            if math.hypot(dx, dy) < 1e-6:
+                out[k] = multiplier_multiple_kernel(ex[k], ey[k], zs[k], kinds, hull_rings, ring_offsets, ring_xy,
+                                                    cxs, cys, czs, r_maxes, r_eff_scales, centers, edges,
+                                                    exponents, min_layers)
+            elif not same_side_kernel(sx[k], sy[k], ex[k], ey[k], zs[k], union_thresholds, union_rings,
+                                      ring_offsets, ring_xy):
+                out[k] = 1.0
+            else:
+                total = 0.0
+                for i in range(num_samples):
+                    frac = (i + 0.5) / num_samples
+                    total += multiplier_multiple_kernel(sx[k] + frac * dx, sy[k] + frac * dy, zs[k], kinds,
+                                                        hull_rings, ring_offsets, ring_xy, cxs, cys, czs, r_maxes,
+                                                        r_eff_scales, centers, edges, exponents, min_layers)
+                out[k] = total / num_samples
+        return out
+
+def build_modifier_arrays(modifiers, union_thresholds, union_polys):
+    """
+    Flatten the loaded modifiers and the prepared 2D unions into the arrays
+    expected by the Numba kernels. Every ring (a modifier's hull, or an
+    exterior or hole of a union) is a slice ring_offsets[r]:ring_offsets[r + 1]
+    of one float64 vertex array. A 2D modifier refers to its hull by ring
+    index (-1 for 3D modifiers); union i covers rings union_rings[i] to
+    union_rings[i + 1] - 1. Vertices and parameters stay in double
+    precision; min_layer and the union thresholds share the float32
+    precision of the Z values they are compared with.
+    """
+    rings = []
+    kinds, hull_rings, cxs, cys, czs, r_eff_scales = [], [], [], [], [], []
+    for mod in modifiers:
+        if mod["modifier_type"] == "2D":
+            kinds.append(MODIFIER_2D)
+            hull_rings.append(len(rings))
+            rings.append(mod["poly_xy"])
+            cxs.append(mod["cx"])
+            cys.append(mod["cy"])
+            czs.append(0.0)
+            r_eff_scales.append(1.0)
+        else:
+            kinds.append(MODIFIER_3D)
+            hull_rings.append(-1)
+            cx, cy, cz = mod["centroid_3d"]
+            cxs.append(cx)
+            cys.append(cy)
+            czs.append(cz)
+            r_eff_scales.append(mod.get("r_eff_scale", 1.0))
+    union_rings = [len(rings)]
+    for union_poly in union_polys:
+        rings.extend(shapely.get_coordinates(ring) for ring in shapely.get_rings(shapely.get_parts(union_poly)))
+        union_rings.append(len(rings))
+    ring_offsets = np.cumsum([0] + [len(ring) for ring in rings], dtype=np.int64)
+    ring_xy = np.concatenate(rings) if rings else np.zeros((0, 2))
+    return (np.array(kinds, dtype=np.int64), np.array(hull_rings, dtype=np.int64),
+            np.array(cxs, dtype=np.float64), np.array(cys, dtype=np.float64), np.array(czs, dtype=np.float64),
+            np.array([mod["r_max"] for mod in modifiers], dtype=np.float64),
+            np.array(r_eff_scales, dtype=np.float64),
+            np.array([mod["center_multiplier"] for mod in modifiers], dtype=np.float64),
+            np.array([mod["edge_multiplier"] for mod in modifiers], dtype=np.float64),
+            np.array([mod["gradient_exponent"] for mod in modifiers], dtype=np.float64),
+            np.array([mod["min_layer"] for mod in modifiers], dtype=COORD_DTYPE),
+            union_thresholds, np.array(union_rings, dtype=np.int64), ring_offsets, ring_xy)
+
+use_numba = USE_NUMBA and NUMBA_AVAILABLE
+
+# --- FUNCTION TO COMPUTE MULTIPLIERS FOR A SINGLE MODIFIER ---
+def compute_multiplier_for_modifier(xs, ys, zs, mod):
+    """
+    Evaluate one modifier at every sample point at once.
+    xs, ys, zs are NumPy arrays of equal length; returns an array of
+    multipliers that is 1.0 wherever the modifier does not apply.
+    """
+    if mod["modifier_type"] == "2D":
+        mask = (zs >= mod["min_layer"]) & shapely.contains_xy(mod["polygon"], xs, ys)
+        r = np.hypot(xs - mod["cx"], ys - mod["cy"])
+        weight = mod["gradient_fn"](np.clip(r * mod["inv_r_max"], 0.0, 1.0))
     elif mod["modifier_type"] == "3D":
         cx, cy, cz = mod["centroid_3d"]
-        if z < cz - mod["r_max"] or z > cz + mod["r_max"]:
-            return 1.0
-        r_eff_scale = mod.get("r_eff_scale", 1.0)
-        r_eff = r_eff_scale * math.sqrt(max(0, mod["r_max"]**2 - (z - cz)**2))
-        d = math.sqrt((x - cx)**2 + (y - cy)**2)
-        if d > r_eff:
-            return 1.0
-        r = d
-        norm_base = r_eff
+        dz_sq = (zs - cz)**2
+        in_range = (zs >= mod["min_layer"]) & (dz_sq <= mod["r_max_sq"])
+        r_eff_sq = mod.get("r_eff_scale", 1.0)**2 * np.maximum(0, mod["r_max_sq"] - dz_sq)
+        d_sq = (xs - cx)**2 + (ys - cy)**2
+        mask = in_range & (d_sq <= r_eff_sq)
+        # r_eff collapses to 0 at the poles of the sphere; treat those points as edge.
+        ratio_sq = np.clip(np.divide(d_sq, r_eff_sq, out=np.ones_like(d_sq), where=r_eff_sq > 0), 0.0, 1.0)
+        if mod["gradient_exponent"] == 2:
+            weight = ratio_sq   # normalized ** 2 without taking the sqrt first
+        else:
+            weight = mod["gradient_fn"](np.sqrt(ratio_sq))
     else:
-        return 1.0
-    normalized = min(r / norm_base, 1.0) ** mod["gradient_exponent"]
-    mod_multiplier = mod["center_multiplier"] - (mod["center_multiplier"] - mod["edge_multiplier"]) * normalized
-    return mod_multiplier
+        return np.ones_like(xs)
+    mod_multiplier = mod["center_multiplier"] - (mod["center_multiplier"] - mod["edge_multiplier"]) * weight
+    return np.where(mask, mod_multiplier, 1.0)
+
+# --- SPATIAL INDEX OF THE 2D MODIFIERS ---
+# With many 2D modifiers, an STRtree over their polygons limits the exact
+# evaluation of each modifier to the points inside its bounding box.
+# Only the NumPy path uses it.
+STRTREE_MIN_MODIFIERS = 8
+modifiers_2d = [mod for mod in modifiers if mod["modifier_type"] == "2D"]
+if not use_numba and len(modifiers_2d) >= STRTREE_MIN_MODIFIERS:
+    modifier_tree = shapely.STRtree([mod["polygon"] for mod in modifiers_2d])
+    tree_bounds = shapely.total_bounds([mod["polygon"] for mod in modifiers_2d])
+else:
+    modifier_tree = None
 
 # --- MULTIPLE MODIFIER GRADIENT FUNCTION ---
-def compute_multiplier_multiple(x, y, z):
-    overall = 1.0
+def compute_multiplier_multiple(xs, ys, zs):
+    overall = np.ones_like(xs)
     for mod in modifiers:
-        m = compute_multiplier_for_modifier(x, y, z, mod)
-        overall *= m
+        if modifier_tree is None or mod["modifier_type"] != "2D":
+            overall *= compute_multiplier_for_modifier(xs, ys, zs, mod)
+    if modifier_tree is not None:
+        # Only points inside the overall bounds of the 2D modifiers are turned into
+        # geometries for the tree query; the rest cannot hit any polygon.
+        minx, miny, maxx, maxy = tree_bounds
+        near = np.flatnonzero((xs >= minx) & (xs <= maxx) & (ys >= miny) & (ys <= maxy))
+        point_idx, tree_idx = modifier_tree.query(shapely.points(xs[near], ys[near]))
+        point_idx = near[point_idx]
+        # Group the (point, polygon) candidate pairs by polygon.
+        order = np.argsort(tree_idx, kind="stable")
+        bounds = np.searchsorted(tree_idx[order], np.arange(len(modifiers_2d) + 1))
+        for i, mod in enumerate(modifiers_2d):
+            cand = point_idx[order[bounds[i]:bounds[i + 1]]]
+            overall[cand] *= compute_multiplier_for_modifier(xs[cand], ys[cand], zs[cand], mod)
     return overall
 
-# --- FUNCTION TO COMPUTE AVERAGE MULTIPLIER ALONG A MOVE ---
-def compute_average_multiplier(start, end, z, num_samples=5):
-    line = LineString([start, end])
-    total = 0.0
-    for i in range(num_samples):
-        frac = (i + 0.5) / num_samples
-        pt = line.interpolate(frac, normalized=True)
-        total += compute_multiplier_multiple(pt.x, pt.y, z)
-    return total / num_samples
-
-# --- FUNCTION TO COMPUTE EFFECTIVE MULTIPLIER FOR A MOVE ---
-def compute_effective_multiplier(start, end, z, num_samples=5):
-    line = LineString([start, end])
-    applicable_polys = [mod["polygon"] for mod in modifiers if mod.get("modifier_type", "2D")=="2D" and z >= mod["min_layer"]]
-    if applicable_polys:
-        union_poly = unary_union(applicable_polys)
-        start_inside = union_poly.contains(Point(start.x, start.y))
-        end_inside = union_poly.contains(Point(end.x, end.y))
-    else:
-        start_inside = end_inside = True
-    if start_inside == end_inside:
-        return compute_average_multiplier(start, end, z, num_samples=num_samples)
-    else:
-        return 1.0
+# --- FUNCTION TO COMPUTE AVERAGE MULTIPLIERS ALONG MOVES ---
+def compute_average_multiplier(sx, sy, ex, ey, zs, num_samples=5):
+    # All samples of all moves form one (moves x samples) grid, evaluated in a single call.
+    fracs = (np.arange(num_samples) + 0.5) / num_samples
+    px = sx[:, None] + fracs * (ex - sx)[:, None]
+    py = sy[:, None] + fracs * (ey - sy)[:, None]
+    pz = np.repeat(zs, num_samples)
+    samples = compute_multiplier_multiple(px.ravel(), py.ravel(), pz)
+    return samples.reshape(px.shape).mean(axis=1)
 
-# --- PROCESSING THE G-CODE (INTEGRATED APPROACH) ---
-positions_3d = []  
-new_E = 0.0
+# --- PREPARED UNIONS OF THE 2D MODIFIERS ---
+# Which 2D modifiers apply to a move only depends on its Z through min_layer,
+# so the union is built and prepared once per distinct min_layer cutoff.
+# union_polys[i] covers every 2D modifier with min_layer <= union_thresholds[i].
+# The thresholds share the precision of the Z values they are compared with, so
+# this test agrees with the `zs >= min_layer` check in compute_multiplier_for_modifier.
+# The Numba kernel tests the same unions, passed as flat rings.
+union_thresholds = np.asarray(sorted({mod["min_layer"] for mod in modifiers
+                                      if mod.get("modifier_type", "2D") == "2D"}), dtype=COORD_DTYPE)
+union_polys = []
+for threshold in union_thresholds:
+    union_poly = unary_union([mod["polygon"] for mod in modifiers
+                              if mod.get("modifier_type", "2D") == "2D" and mod["min_layer"] <= threshold])
+    shapely.prepare(union_poly)
+    union_polys.append(union_poly)
+if use_numba:
+    modifier_arrays = build_modifier_arrays(modifiers, union_thresholds, union_polys)
+else:
+    # Object array for per-move lookup. Index -1 (no applicable 2D modifier) picks
+    # the trailing None, for which contains_xy reports False at both move ends.
+    union_lookup = np.array(union_polys + [None], dtype=object)
+
+# --- FUNCTION TO COMPUTE EFFECTIVE MULTIPLIERS FOR MOVES ---
+def compute_effective_multiplier(sx, sy, ex, ey, zs, num_samples=5):
+    """
+    Compute the extrusion multiplier of every move (start -> end at height z).
+    Moves that cross the boundary of the applicable 2D modifiers keep 1.0,
+    zero-length moves use the multiplier at their end point.
+    """
+    if use_numba:
+        return process_moves(sx, sy, ex, ey, zs, num_samples, *modifier_arrays)
+    # Union that applies at each move's Z; -1 means no 2D modifier applies.
+    union_index = np.searchsorted(union_thresholds, zs, side="right") - 1
+    move_unions = union_lookup[union_index]
+    start_inside = shapely.contains_xy(move_unions, sx, sy)
+    end_inside = shapely.contains_xy(move_unions, ex, ey)
+    same_side = start_inside == end_inside
+    effective = np.where(same_side, compute_average_multiplier(sx, sy, ex, ey, zs, num_samples=num_samples), 1.0)
+    zero_length = np.hypot(ex - sx, ey - sy) < 1e-6
+    effective[zero_length] = compute_multiplier_multiple(ex[zero_length], ey[zero_length], zs[zero_length])
+    return effective
+
+# --- PASS 1: PARSE THE G-CODE INTO MOVE ARRAYS ---
+# The file is read in one call and split into byte lines (line endings kept).
+with open(input_file, "rb") as fin:
+    lines = fin.read().splitlines(keepends=True)
+
+# Every extrusion move is stored in preallocated per-field arrays (SoA),
+# sized by a cheap counting pass; n_moves is the write cursor.
+max_moves = sum(1 for line in lines if line.startswith(b"G1") and b"E" in line)
+move_lines = np.empty(max_moves, dtype=np.int64)   # Index into `lines` of every extrusion move.
+starts_x = np.empty(max_moves, dtype=COORD_DTYPE)
+starts_y = np.empty(max_moves, dtype=COORD_DTYPE)
+xs_all = np.empty(max_moves, dtype=COORD_DTYPE)
+ys_all = np.empty(max_moves, dtype=COORD_DTYPE)
+zs_all = np.empty(max_moves, dtype=COORD_DTYPE)
+delta_Es = np.empty(max_moves, dtype=np.float64)
+e_starts = np.empty(max_moves, dtype=np.int64)   # Span of the E word, rewritten in pass 2.
+e_ends = np.empty(max_moves, dtype=np.int64)
+n_moves = 0
+e_resets = {}     # Line index -> E value of every G92 extrusion reset.
 last_E = 0.0
 last_x, last_y, last_z = None, None, 0
 
-with open(input_file, "r") as fin, open(output_file, "w") as fout:
-    for line in fin:
-        if line.startswith("G92") and "E" in line:
-            match = pattern_e.search(line)
+for line_no, line in enumerate(lines):
+    # Only moves and G92 can change Z or E; comments, M-codes and blank
+    # lines are skipped before any regex runs.
+    if not line.startswith((b"G0", b"G1", b"G2", b"G3", b"G92")):
+        continue
+    if line.startswith(b"G92"):
+        e_pos = line.find(b"E")
+        if e_pos >= 0:
+            match = pattern_e.match(line, e_pos)
             if match:
                 reset_val = float(match.group(1))
                 last_E = reset_val
-                new_E = reset_val
+                e_resets[line_no] = reset_val
                 print(f"Reset extrusion with G92: setting E to {reset_val}")
-            fout.write(line)
             continue
+    if not (line.startswith(b"G1") and b"E" in line):
         z_match = pattern_z.search(line)
         if z_match:
             last_z = float(z_match.group(1))
-        if line.startswith("G1") and "E" in line:
-            x_match = pattern_x.search(line)
-            y_match = pattern_y.search(line)
-            e_match = pattern_e.search(line)
-            if e_match:
-                current_E = float(e_match.group(1))
-                delta_E = current_E - last_E
-                last_E = current_E
-                if x_match and y_match:
-                    x = float(x_match.group(1))
-                    y = float(y_match.group(1))
-                    start_pt = Point(last_x, last_y) if (last_x is not None and last_y is not None) else Point(x, y)
-                    last_x, last_y = x, y
-                elif last_x is not None and last_y is not None:
-                    x, y = last_x, last_y
-                    start_pt = Point(last_x, last_y)
-                else:
-                    x, y = 0, 0
-                    start_pt = Point(0, 0)
-                end_pt = Point(x, y)
-                z = last_z  
-                total_length = LineString([start_pt, end_pt]).length
-                if total_length < 1e-6:
-                    m_val = compute_multiplier_multiple(x, y, z)
-                    seg_delta = delta_E * m_val
-                    new_E += seg_delta
-                    new_line = re.sub(r'E[-+]?[0-9]*\.?[0-9]+', f"E{new_E:.5f}", line)
-                    fout.write(new_line)
-                    positions_3d.append((x, y, z, m_val))
-                else:
-                    effective_m = compute_effective_multiplier(start_pt, end_pt, z, num_samples=5)
-                    new_delta = delta_E * effective_m
-                    new_E += new_delta
-                    new_line = re.sub(r'E[-+]?[0-9]*\.?[0-9]+', f"E{new_E:.5f}", line)
-                    fout.write(new_line)
-                    positions_3d.append((end_pt.x, end_pt.y, z, effective_m))
-            else:
-                fout.write(line)
-        else:
-            fout.write(line)
+        continue
+    fields = {}
+    for match in pattern_token.finditer(line):
+        fields.setdefault(match.group(1), match)
+    if b"Z" in fields:
+        last_z = float(fields[b"Z"].group(2))
+    e_match = fields.get(b"E")
+    if not e_match:
+        continue
+    x_match = fields.get(b"X")
+    y_match = fields.get(b"Y")
+    current_E = float(e_match.group(2))
+    delta_E = current_E - last_E
+    last_E = current_E
+    if x_match and y_match:
+        x = float(x_match.group(2))
+        y = float(y_match.group(2))
+        start_x, start_y = (last_x, last_y) if (last_x is not None and last_y is not None) else (x, y)
+        last_x, last_y = x, y
+    elif last_x is not None and last_y is not None:
+        x, y = last_x, last_y
+        start_x, start_y = last_x, last_y
+    else:
+        x, y = 0, 0
+        start_x, start_y = 0, 0
+    move_lines[n_moves] = line_no
+    starts_x[n_moves] = start_x
+    starts_y[n_moves] = start_y
+    xs_all[n_moves] = x
+    ys_all[n_moves] = y
+    zs_all[n_moves] = last_z
+    delta_Es[n_moves] = delta_E
+    e_starts[n_moves], e_ends[n_moves] = e_match.span()
+    n_moves += 1
+
+# Drop the slots reserved for G1 lines that turned out to carry no E value.
+move_lines = move_lines[:n_moves]
+starts_x = starts_x[:n_moves]
+starts_y = starts_y[:n_moves]
+xs_all = xs_all[:n_moves]
+ys_all = ys_all[:n_moves]
+zs_all = zs_all[:n_moves]
+delta_Es = delta_Es[:n_moves]
+e_starts = e_starts[:n_moves]
+e_ends = e_ends[:n_moves]
+multipliers_all = compute_effective_multiplier(starts_x, starts_y, xs_all, ys_all, zs_all, num_samples=5)
+
+# --- PASS 2: WRITE THE MODIFIED G-CODE ---
+move_index = {line_no: k for k, line_no in enumerate(move_lines.tolist())}
+new_deltas = (delta_Es * multipliers_all).tolist()
+e_spans = list(zip(e_starts.tolist(), e_ends.tolist()))
+new_E = 0.0
+
+# Lines are collected and written in blocks of about OUTPUT_BUFFER_SIZE bytes.
+OUTPUT_BUFFER_SIZE = 1 << 20
+out_buf = []
+out_buf_len = 0
+
+with open(output_file, "wb") as fout:
+    for line_no, line in enumerate(lines):
+        if line_no in e_resets:
+            new_E = e_resets[line_no]
+        elif line_no in move_index:
+            k = move_index[line_no]
+            new_E += new_deltas[k]
+            start, end = e_spans[k]
+            line = b"%sE%.5f%s" % (line[:start], new_E, line[end:])
+        out_buf.append(line)
+        out_buf_len += len(line)
+        if out_buf_len > OUTPUT_BUFFER_SIZE:
+            fout.write(b"".join(out_buf))
+            out_buf.clear()
+            out_buf_len = 0
+    fout.write(b"".join(out_buf))
 
-if not positions_3d:
+if n_moves == 0:
     print("No extrusion moves found in the input G-code.")
 else:
-    xs_all = [pt[0] for pt in positions_3d]
-    ys_all = [pt[1] for pt in positions_3d]
-    zs_all = [pt[2] for pt in positions_3d]
-    print(f"G-code X range: {min(xs_all):.2f} to {max(xs_all):.2f}")
-    print(f"G-code Y range: {min(ys_all):.2f} to {max(ys_all):.2f}")
-    print(f"G-code Z range: {min(zs_all):.2f} to {max(zs_all):.2f}")
+    print(f"G-code X range: {xs_all.min():.2f} to {xs_all.max():.2f}")
+    print(f"G-code Y range: {ys_all.min():.2f} to {ys_all.max():.2f}")
+    print(f"G-code Z range: {zs_all.min():.2f} to {zs_all.max():.2f}")
 
 # --- DOWNSAMPLING FOR VISUALIZATION ---
 max_points = 10000
-if len(positions_3d) > max_points:
-    sample_rate = int(len(positions_3d) / max_points)
-    positions_sampled = positions_3d[::sample_rate]
+if n_moves > max_points:
+    sample_rate = int(n_moves / max_points)
     print(f"Downsampling: using every {sample_rate}th point for preview.")
 else:
-    positions_sampled = positions_3d
+    sample_rate = 1
 
-xs = np.array([pt[0] for pt in positions_sampled])
-ys = np.array([pt[1] for pt in positions_sampled])
-zs = np.array([pt[2] for pt in positions_sampled])
-multipliers = np.array([pt[3] for pt in positions_sampled])
+# The preview points are sorted by Z once, so every slider position selects a prefix.
+order = np.argsort(zs_all[::sample_rate], kind="stable")
+xs = xs_all[::sample_rate][order]
+ys = ys_all[::sample_rate][order]
+zs = zs_all[::sample_rate][order]
+multipliers = multipliers_all[::sample_rate][order]
 
 # --- 3D VISUALIZATION WITH SLIDER ---
 
@@ -340,14 +661,9 @@ z_max = max(zs)
 slider = Slider(slider_ax, "Max Z", z_min, z_max, valinit=z_max)
 
 def update(val):
-    threshold = slider.val
-    mask = zs <= threshold
-    new_xs = xs[mask]
-    new_ys = ys[mask]
-    new_zs = zs[mask]
-    new_multipliers = multipliers[mask]
-    scatter._offsets3d = (new_xs, new_ys, new_zs)
-    scatter.set_array(new_multipliers)
+    k = np.searchsorted(zs, slider.val, side="right")
+    scatter._offsets3d = (xs[:k], ys[:k], zs[:k])
+    scatter.set_array(multipliers[:k])
     fig.canvas.draw_idle()
 
 slider.on_changed(update)